@@ -1,18 +1,36 @@
+import calendar
 import deepl
 import dotenv
 import json
+import os
 import re
 
 from argparse import ArgumentParser
 from datetime import datetime
-from dateutil.relativedelta import relativedelta
 from pathlib import Path
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, FrozenSet, Optional
+
+
+_SEARCH_RE = re.compile(
+    r'(?P<both><source>(?P<source>[^<]+)</source>\s+(?P<target><target state="needs-translation"/>))'
+)
+_COMMENT_RE = re.compile(
+    r'(?P<both><source>(?P<source>[^<]+)</source>\s+(?P<target><target state="needs-translation"/>))\s+'
+    r'(?P<comment><note from="Developer" annotates="general" priority="2">(?P<code>[a-z]{2}-[A-Z]{2})='
+    r'"(?P<expression>[^"]+)"</note>)'
+)
+_DONE_RE = re.compile(r'<source>(?P<source>.+)</source>\s+?<target>(?P<target>.+)</target>')
+
+
+def _add_month(date: datetime) -> datetime:
+    year, month = date.year + date.month // 12, date.month % 12 + 1
+    day = min(date.day, calendar.monthrange(year, month)[1])
+    return date.replace(year=year, month=month, day=day)
 
 
 class DeeplHistory:
     def __init__(self):
-        self.old_data: Optional[List[Dict[str, Any]]] = None
+        self.last_data: Optional[Dict[str, Any]] = None
         self.resources_path = Path('./resources')
         self.json_path: Optional[Path] = None
         self.max_chars_per_month = 0
@@ -21,29 +39,58 @@ class DeeplHistory:
         self.last_date: Optional[datetime] = None
 
     def init(self):
-        self.json_path = self.resources_path.joinpath('deepl.json')
-        with self.json_path.open('r', encoding='utf8') as fp:
-            self.old_data = json.load(fp)
-        data = self.old_data[-1]
+        self.json_path = self.resources_path.joinpath('deepl.jsonl')
+        if not self.json_path.exists():
+            self._migrate_json_history()
+        self.last_data = json.loads(self._read_last_line())
+        data = self.last_data
         self.max_chars_per_month = data['max_chars_per_month']
         self.sent_chars = data['sent_chars']
 
-        self.start_date = datetime.strptime(data['date'], '%Y-%m-%d %H:%M')
-        next_date = self.start_date + relativedelta(months=1)
+        self.start_date = datetime.fromisoformat(data['date'])
+        next_date = _add_month(self.start_date)
         if datetime.now() > next_date:
             self.start_date = datetime.now()
             self.sent_chars = 0
 
     def save(self):
-        with self.json_path.open('w', encoding='utf8') as fp:
-            new_data = {
-                'max_chars_per_month': self.max_chars_per_month,
-                'sent_chars': self.sent_chars,
-                'date': f"{self.start_date:%Y-%m-%d %H:%M}",
-                'last':  f"{datetime.now():%Y-%m-%d %H:%M}"
-            }
-            self.old_data.append(new_data)
-            json.dump(self.old_data, fp, indent=2)
+        new_data = {
+            'max_chars_per_month': self.max_chars_per_month,
+            'sent_chars': self.sent_chars,
+            'date': self.start_date.isoformat(sep=' ', timespec='minutes'),
+            'last': datetime.now().isoformat(sep=' ', timespec='minutes')
+        }
+        with self.json_path.open('a+b') as fp:
+            size = fp.seek(0, os.SEEK_END)
+            if size:
+                fp.seek(size - 1)
+                if fp.read(1) != b'\n':
+                    fp.write(b'\n')
+            fp.write(f'{json.dumps(new_data)}\n'.encode('utf8'))
+        self.last_data = new_data
+
+    def _migrate_json_history(self):
+        legacy_path = self.resources_path.joinpath('deepl.json')
+        if not legacy_path.exists():
+            raise FileNotFoundError(f'No se encontró el historial {self.json_path}.')
+        old_data = json.loads(legacy_path.read_bytes())
+        self.json_path.write_text(''.join(f'{json.dumps(data)}\n' for data in old_data), encoding='utf8')
+
+    def _read_last_line(self) -> bytes:
+        with self.json_path.open('rb') as fp:
+            size = fp.seek(0, os.SEEK_END)
+            block = 1024
+            while True:
+                start = max(0, size - block)
+                fp.seek(start)
+                lines = fp.read().splitlines()
+                lines = [line for line in lines if line.strip()]
+                if start == 0 or len(lines) > 1:
+                    break
+                block *= 2
+        if not lines:
+            raise ValueError(f'{self.json_path} está vacío.')
+        return lines[-1]
 
 
 class DeeplTranslator:
@@ -55,32 +102,36 @@ class DeeplTranslator:
         self.translated_tradnl_source_path: Optional[Path] = None
         self.raw_path: Optional[Path] = None
         self.start_date: Optional[datetime] = None
-        self.deepl: Any = deepl.Translator(self.auth_key)
+        self._deepl: Any = None
         self.source = ''
         self.source_in_env = False
         self.source_items = set()
         self.target_items = []
         self.keep_known_translations: bool = False
         self.fixes = {}
-        self.search_pattern = re.compile(
-            r'(?P<both><source>(?P<source>[^<]+)</source>\s+(?P<target><target state="needs-translation"/>))',
-            re.S
-        )
-        self.comment_pattern = re.compile(
-            r'(?P<both><source>(?P<source>[^<]+)</source>\s+(?P<target><target state="needs-translation"/>))\s+'
-            r'(?P<comment><note from="Developer" annotates="general" priority="2">(?P<code>[a-z]{2}-[A-Z]{2})='
-            r'"(?P<expression>[^"]+)"</note>)',
-            re.S
-        )
-        self.done_pattern = re.compile(
-            r'<source>(?P<source>.+)</source>\s+?<target>(?P<target>.+)</target>',
-            re.UNICODE
-        )
+        self._translations_cache: Optional[Dict[str, str]] = None
+        self._skip: Optional[FrozenSet[str]] = None
+        self.search_pattern = _SEARCH_RE
+        self.comment_pattern = _COMMENT_RE
+        self.done_pattern = _DONE_RE
+        self._env: Optional[Dict[str, Optional[str]]] = None
         self._set_paths()
 
+    @property
+    def deepl(self):
+        if self._deepl is None:
+            self._deepl = deepl.Translator(self.auth_key)
+        return self._deepl
+
+    @property
+    def env(self):
+        if self._env is None:
+            self._env = dotenv.dotenv_values('resources/.env', verbose=True)
+        return self._env
+
     @property
     def auth_key(self):
-        auth_key = args.deepl_authkey if args.deepl_authkey else dotenv.get_key('resources/.env', 'DEEPLAUTHKEY')
+        auth_key = args.deepl_authkey if args.deepl_authkey else self.env.get('DEEPLAUTHKEY')
         if not auth_key:
             raise KeyError('Debe proporcionar una clave API de deepl.')
         return auth_key
@@ -89,7 +140,7 @@ class DeeplTranslator:
         self.resources_path = Path('./resources')
 
         if args.source_in_env:
-            args.source = dotenv.get_key('resources/.env', 'SOURCE')
+            args.source = self.env.get('SOURCE')
 
         if args.source:
             self.source_path = self.resources_path.joinpath(f'{args.source}.xlf')
@@ -104,8 +155,7 @@ class DeeplTranslator:
         self.history.init()
 
     def read_source(self):
-        with self.source_path.open('r', encoding='utf8') as f:
-            self.source = f.read()
+        self.source = self.source_path.read_text(encoding='utf8')
 
     def read_and_show(self):
         self.read_source()
@@ -115,38 +165,45 @@ class DeeplTranslator:
         print(f'items: {len(self.source_items)} size: {len(items)}')
 
     def skip_expressions(self):
-        expressions = []
-        with open('resources/skip_expressions.txt') as fp:
-            text = fp.read()
-        for expression in text.splitlines():
-            expressions.append(expression.strip())
-        return expressions
+        if self._skip is None:
+            text = Path('resources/skip_expressions.txt').read_text(encoding='utf8')
+            self._skip = frozenset(expression.strip() for expression in text.splitlines())
+        return self._skip
 
     def get_fixes(self):
-        with open('resources/fixes.json') as fp:
-            fixes = json.load(fp)
-        return fixes
+        return json.loads(Path('resources/fixes.json').read_bytes())
 
     def fix(self):
-        translations = self.collect_translations()
         fixes = self.get_fixes()
-        data = {}
-        tr = translations.copy()
-        for src_lang, tgt_lang in tr.items():
-            for fix in fixes:
-                if fix in tgt_lang:
-                    data.update({tgt_lang: tgt_lang.replace(fix, fixes[fix])})
+        words = {k: v for k, v in fixes.items() if not len(k) == len(v) == 1}
+        chars = {k: v for k, v in fixes.items() if k not in words}
+        # A character fix may only skip the alternation if it can neither break nor create any typo it handles.
+        moved = True
+        while moved:
+            moved = {k: v for k, v in chars.items() if any(k in typo or v in typo for typo in words)}
+            words.update(moved)
+            chars = {k: v for k, v in chars.items() if k not in moved}
+        table = str.maketrans(chars)
+        if words:
+            typos = re.compile('|'.join(map(re.escape, sorted(words, key=len, reverse=True))))
+
+        def _fix_target(match):
+            text = match.group(0)
+            start, end = match.start('target') - match.start(), match.end('target') - match.start()
+            target = text[start:end].translate(table)
+            if words:
+                target = typos.sub(lambda m: words[m.group(0)], target)
+            return text[:start] + target + text[end:]
 
         with self.translated_source_path.open('r+', encoding='utf8') as fp:
             old_text = fp.read()
-            new_text = str(old_text)
-            for typo, fix in data.items():
-                new_text = new_text.replace(typo, fix)
+            new_text = self.done_pattern.sub(_fix_target, old_text) if fixes else old_text
             if old_text == new_text:
                 raise NotImplementedError('Ací passa algo estrany!')
             fp.seek(0)
             fp.write(new_text)
             fp.truncate()
+        self._translations_cache = None
 
     def get_untranslated_items(self):
         sources = set()
@@ -154,41 +211,46 @@ class DeeplTranslator:
         for items in self.search_pattern.finditer(self.source):
             expr, source, target = items.groups()
             sources.add(source)
-        sources = sources.difference(skip)
+        sources -= skip
         if self.keep_known_translations:
             known_translations = self.collect_translations()
-            not_translated_sources = sources.difference(known_translations.keys())
-            if len(not_translated_sources) == 0 and len(sources) > 0:
+            if sources and sources <= known_translations.keys():
                 raise IndexError('Ya se han traducido todas las expresiones.')
-        self.source_items = list(sorted(sources))
+        self.source_items = sorted(sources)
 
     def save_raw(self):
         translations = '\n'.join(f'{k}: {v}' for k, v in zip(self.source_items, self.target_items))
-        with self.raw_path.open('w', encoding='utf8') as fp:
-            fp.write(translations)
+        self.raw_path.write_text(translations, encoding='utf8')
 
     def translate(self):
-        translations = {k: v for k, v in zip(self.source_items, self.target_items)}
-        target_text = f'{self.source}'
-        new_line = '\n'
-        for k, v in translations.items():
-            old = f'<source>{k}</source>{new_line:<11}<target state="needs-translation"/>'
-            new = f'<source>{k}</source>{new_line:<11}<target>{v}</target>'
-            target_text = target_text.replace(old, new)
+        translations = dict(zip(self.source_items, self.target_items))
+        pad = '\n' + ' ' * 10
+
+        def _repl(match):
+            k = match.group('source')
+            v = translations.get(k)
+            if v is None or match.group(0) != f'<source>{k}</source>{pad}<target state="needs-translation"/>':
+                return match.group(0)
+            return f'<source>{k}</source>{pad}<target>{v}</target>'
 
         with self.translated_source_path.open('w', encoding='utf8') as fp:
-            fp.write(target_text)
+            last = 0
+            for match in self.search_pattern.finditer(self.source):
+                fp.write(self.source[last:match.start()])
+                fp.write(_repl(match))
+                last = match.end()
+            fp.write(self.source[last:])
+        self._translations_cache = None
 
     def collect_translations(self):
+        if self._translations_cache is not None:
+            return self._translations_cache
         if not self.translated_source_path.exists():
             # raise FileNotFoundError('No se encontró el fichero fuente.')
             return {}
-        with self.translated_source_path.open('r', encoding='utf8') as fp:
-            text = fp.read()
-        translations_list = self.done_pattern.findall(text)
-        translations_list.sort(key=lambda it: it[0])
-        translations = {k: v for k, v in dict(translations_list).items()}
-        return translations
+        text = self.translated_source_path.read_text(encoding='utf8')
+        self._translations_cache = dict(self.done_pattern.findall(text))
+        return self._translations_cache
 
     def test(self):
         self.load()
@@ -198,11 +260,15 @@ class DeeplTranslator:
 
     def replace_comments(self):
         indent = '          '
+        parts = []
+        last = 0
         for items in self.comment_pattern.finditer(self.source):
             both, source, target, comment, lang_code, transl = items.groups()
-            repl = items.group(0)
-            new = f'<source>{source}</source>\n{indent}<target>{transl}</target>\n{indent}{comment}'
-            self.source = self.source.replace(repl, new)
+            parts.append(self.source[last:items.start()])
+            parts.append(f'<source>{source}</source>\n{indent}<target>{transl}</target>\n{indent}{comment}')
+            last = items.end()
+        parts.append(self.source[last:])
+        self.source = ''.join(parts)
 
     def main(self):
         self.load()
@@ -234,16 +300,14 @@ class DeeplTranslator:
             self.get_untranslated_items()
         except IndexError as exception:
             pass
-        with self.translated_source_path.open('w', encoding='utf8') as fp:
-            fp.write(self.source)
+        self.translated_source_path.write_text(self.source, encoding='utf8')
+        self._translations_cache = None
 
     def add_traditional_spanish_version(self):
-        with self.translated_source_path.open('r', encoding='utf8') as fp_r:
-            text = fp_r.read()
-            text = text.replace('target-language="es-ES"', 'target-language="es-ES_tradnl"', 1)
+        text = self.translated_source_path.read_text(encoding='utf8')
+        text = text.replace('target-language="es-ES"', 'target-language="es-ES_tradnl"', 1)
         if text:
-            with self.translated_tradnl_source_path.open('w', encoding='utf8') as fp_w:
-                fp_w.write(text)
+            self.translated_tradnl_source_path.write_text(text, encoding='utf8')
 
 
 if __name__ == '__main__':
@@ -302,7 +366,8 @@ if __name__ == '__main__':
     a la línea de órdenes. La sintaxis para el comentario debe ser: comment = 'es-ES="traducción"';  
         
     3.- Ejecutamos --translate. Esta orden le manda al API de Deepl las expresiones que tenemos que traducir, hay que
-    tener en cuenta que son 500.000 carácteres al mes, el recuento se hace en deepl.json.
+    tener en cuenta que son 500.000 carácteres al mes, el recuento se hace en deepl.jsonl.
+    (Si solo existe el antiguo deepl.json, se convierte automáticamente a deepl.jsonl la primera vez.)
     
     4.- Leemos de nuevo, si alguna expresión está mal, añadimos en fixes.json la expr. incorrecta y la corrección que
     queremos que se haga a modo de clave valor. Una vez las hemos obtenido, ejecutamos --fixes.